@@ -44,7 +44,8 @@ def random_shift(vertices, shift_factor=0.25):
 def make_vertex_model_dataset(ds, apply_random_shift=False):
   """Prepare dataset for vertex model training."""
   def _vertex_model_map_fn(example):
-    vertices = example['vertices']
+    # Vertices may be stored in a narrower integer type.
+    vertices = tf.cast(example['vertices'], tf.int32)
 
     # Randomly shift vertices
     if apply_random_shift:
@@ -63,14 +64,15 @@ def make_vertex_model_dataset(ds, apply_random_shift=False):
     example['vertices_flat_mask'] = tf.ones_like(
         example['vertices_flat'], dtype=tf.float32)
     return example
-  return ds.map(_vertex_model_map_fn)
+  return ds.map(
+      _vertex_model_map_fn, num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
 
 def make_face_model_dataset(
     ds, apply_random_shift=False, shuffle_vertices=True, quantization_bits=8):
   """Prepare dataset for face model training."""
   def _face_model_map_fn(example):
-    vertices = example['vertices']
+    vertices = tf.cast(example['vertices'], tf.int32)
 
     # Randomly shift vertices
     if apply_random_shift:
@@ -85,7 +87,8 @@ def make_face_model_dataset(
           [tf.constant([0, 1], dtype=tf.int32), tf.argsort(permutation) + 2],
           axis=0)
       example['faces'] = tf.cast(
-          tf.gather(face_permutation, example['faces']), tf.int64)
+          tf.gather(face_permutation, tf.cast(example['faces'], tf.int32)),
+          example['faces'].dtype)
 
     def _dequantize_verts(verts, n_bits):
       min_range = -0.5
@@ -101,7 +104,8 @@ def make_face_model_dataset(
         example['vertices'][..., 0], dtype=tf.float32)
     example['faces_mask'] = tf.ones_like(example['faces'], dtype=tf.float32)
     return example
-  return ds.map(_face_model_map_fn)
+  return ds.map(
+      _face_model_map_fn, num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
 
 def read_obj_file(obj_file):
@@ -212,18 +216,16 @@ def flatten_faces(faces):
 
 def unflatten_faces(flat_faces):
   """Converts from flat face sequence to a list of separate faces."""
-  def group(seq):
-    g = []
-    for el in seq:
-      if el == 0 or el == -1:
-        yield g
-        g = []
-      else:
-        g.append(el - 1)
-    yield g
-  outputs = list(group(flat_faces - 1))[:-1]
+  flat_faces = np.asarray(flat_faces)
+  # Faces are delimited by new face (1) and stopping (0) tokens. Indices after
+  # the last delimiter belong to an incomplete face and are discarded.
+  delimiters = np.flatnonzero(flat_faces < 2)
+  if not delimiters.size:
+    return []
+  outputs = np.split(flat_faces[:delimiters[-1]] - 2, delimiters[:-1])
+  outputs = outputs[:1] + [o[1:] for o in outputs[1:]]
   # Remove empty faces
-  return [o for o in outputs if len(o) > 2]
+  return [o.tolist() for o in outputs if len(o) > 2]
 
 
 def center_vertices(vertices):
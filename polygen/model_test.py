@@ -13,7 +13,10 @@
 # limitations under the License.
 
 """Tests for the PolyGen open-source version."""
+from data_utils import unflatten_faces
 from modules import FaceModel
+from modules import TransformerDecoder
+from modules import TransformerEncoder
 from modules import VertexModel
 import numpy as np
 import tensorflow as tf
@@ -37,16 +40,29 @@ _MAX_SAMPLE_LENGTH_VERTS = 10
 _MAX_SAMPLE_LENGTH_FACES = 10
 
 
-def _get_vertex_model_batch():
+def _has_bfloat16_kernels():
+  """Returns True if the attention ops have bfloat16 kernels on this device."""
+  with tf.Graph().as_default():
+    x = tf.zeros([1, 2, 2], dtype=tf.bfloat16)
+    y = tf.nn.softmax(tf.matmul(x, x))
+    try:
+      with tf.Session() as sess:
+        sess.run(y)
+    except tf.errors.OpError:
+      return False
+  return True
+
+
+def _get_vertex_model_batch(token_dtype=tf.int32):
   """Returns batch with placeholders for vertex model inputs."""
   return {
       'class_label': tf.range(_BATCH_SIZE),
       'vertices_flat': tf.placeholder(
-          dtype=tf.int32, shape=[_BATCH_SIZE, None]),
+          dtype=token_dtype, shape=[_BATCH_SIZE, None]),
   }
 
 
-def _get_face_model_batch():
+def _get_face_model_batch(token_dtype=tf.int32):
   """Returns batch with placeholders for face model inputs."""
   return {
       'vertices': tf.placeholder(
@@ -54,17 +70,19 @@ def _get_face_model_batch():
       'vertices_mask': tf.placeholder(
           dtype=tf.float32, shape=[_BATCH_SIZE, None]),
       'faces': tf.placeholder(
-          dtype=tf.int32, shape=[_BATCH_SIZE, None]),
+          dtype=token_dtype, shape=[_BATCH_SIZE, None]),
   }
 
 
 class VertexModelTest(tf.test.TestCase):
 
+  transformer_config = _TRANSFORMER_CONFIG
+
   def setUp(self):
     """Defines a vertex model."""
     super(VertexModelTest, self).setUp()
     self.model = VertexModel(
-        decoder_config=_TRANSFORMER_CONFIG,
+        decoder_config=self.transformer_config,
         class_conditional=_CLASS_CONDITIONAL,
         num_classes=_NUM_CLASSES,
         max_num_input_verts=_NUM_INPUT_VERTS,
@@ -83,6 +101,18 @@ class VertexModelTest(tf.test.TestCase):
           size=[_BATCH_SIZE, _NUM_INPUT_VERTS * 3 + 1])
       sess.run(logits, {batch['vertices_flat']: vertices_flat})
 
+  def test_model_runs_with_int16_tokens(self):
+    """Tests if the model runs on vertex tokens stored as int16."""
+    batch = _get_vertex_model_batch(token_dtype=tf.int16)
+    pred_dist = self.model(batch, is_training=False)
+    logits = pred_dist.logits
+    with self.session() as sess:
+      sess.run(tf.global_variables_initializer())
+      vertices_flat = np.random.randint(
+          2**_QUANTIZATION_BITS + 1,
+          size=[_BATCH_SIZE, _NUM_INPUT_VERTS * 3 + 1]).astype(np.int16)
+      sess.run(logits, {batch['vertices_flat']: vertices_flat})
+
   def test_sample_outputs_range(self):
     """Tests if the model produces samples in the correct range."""
     context = {'class_label': tf.zeros((_BATCH_SIZE,), dtype=tf.int32)}
@@ -100,12 +130,14 @@ class VertexModelTest(tf.test.TestCase):
 
 class FaceModelTest(tf.test.TestCase):
 
+  transformer_config = _TRANSFORMER_CONFIG
+
   def setUp(self):
     """Defines a face model."""
     super(FaceModelTest, self).setUp()
     self.model = FaceModel(
-        encoder_config=_TRANSFORMER_CONFIG,
-        decoder_config=_TRANSFORMER_CONFIG,
+        encoder_config=self.transformer_config,
+        decoder_config=self.transformer_config,
         class_conditional=False,
         max_seq_length=_NUM_INPUT_FACE_INDICES,
         decoder_cross_attention=_FACE_MODEL_DECODER_CROSS_ATTENTION,
@@ -130,6 +162,25 @@ class FaceModelTest(tf.test.TestCase):
            batch['faces']: faces}
           )
 
+  def test_model_runs_with_int16_tokens(self):
+    """Tests if the model runs on face tokens stored as int16."""
+    batch = _get_face_model_batch(token_dtype=tf.int16)
+    pred_dist = self.model(batch, is_training=False)
+    logits = pred_dist.logits
+    with self.session() as sess:
+      sess.run(tf.global_variables_initializer())
+      vertices = np.random.rand(_BATCH_SIZE, _NUM_INPUT_VERTS, 3) - 0.5
+      vertices_mask = np.ones([_BATCH_SIZE, _NUM_INPUT_VERTS])
+      faces = np.random.randint(
+          _NUM_INPUT_VERTS + 2,
+          size=[_BATCH_SIZE, _NUM_INPUT_FACE_INDICES]).astype(np.int16)
+      sess.run(
+          logits,
+          {batch['vertices']: vertices,
+           batch['vertices_mask']: vertices_mask,
+           batch['faces']: faces}
+          )
+
   def test_sample_outputs_range(self):
     """Tests if the model produces samples in the correct range."""
     context = _get_face_model_batch()
@@ -155,5 +206,89 @@ class FaceModelTest(tf.test.TestCase):
           sample_dict_np['faces'] <= _NUM_INPUT_VERTS + 1).all()
       self.assertTrue(in_range)
 
+
+class VertexModelBfloat16Test(VertexModelTest):
+  """Runs the vertex model tests with bfloat16 activations."""
+
+  transformer_config = dict(_TRANSFORMER_CONFIG, activation_dtype=tf.bfloat16)
+
+  def setUp(self):
+    if not _has_bfloat16_kernels():
+      self.skipTest('bfloat16 kernels are not available.')
+    super(VertexModelBfloat16Test, self).setUp()
+
+
+class FaceModelBfloat16Test(FaceModelTest):
+  """Runs the face model tests with bfloat16 activations."""
+
+  transformer_config = dict(_TRANSFORMER_CONFIG, activation_dtype=tf.bfloat16)
+
+  def setUp(self):
+    if not _has_bfloat16_kernels():
+      self.skipTest('bfloat16 kernels are not available.')
+    super(FaceModelBfloat16Test, self).setUp()
+
+
+class TransformerActivationDtypeTest(tf.test.TestCase):
+
+  def _get_inputs(self):
+    """Returns a placeholder for embedded float32 inputs."""
+    return tf.placeholder(
+        dtype=tf.float32,
+        shape=[_BATCH_SIZE, None, _TRANSFORMER_CONFIG['hidden_size']])
+
+  def test_encoder_bfloat16_dtypes(self):
+    """Tests bfloat16 encoder variables and outputs are float32."""
+    encoder = TransformerEncoder(
+        activation_dtype=tf.bfloat16, **_TRANSFORMER_CONFIG)
+    outputs = encoder(self._get_inputs())
+    self.assertEqual(outputs.dtype, tf.float32)
+    for variable in encoder.get_all_variables():
+      self.assertEqual(variable.dtype.base_dtype, tf.float32)
+
+  def test_decoder_bfloat16_dtypes(self):
+    """Tests bfloat16 decoder variables and outputs are float32."""
+    decoder = TransformerDecoder(
+        activation_dtype=tf.bfloat16, **_TRANSFORMER_CONFIG)
+    outputs = decoder(
+        self._get_inputs(), sequential_context_embeddings=self._get_inputs())
+    self.assertEqual(outputs.dtype, tf.float32)
+    for variable in decoder.get_all_variables():
+      self.assertEqual(variable.dtype.base_dtype, tf.float32)
+
+  def test_memory_efficient_requires_float32(self):
+    """Tests memory efficient attention rejects other activation dtypes."""
+    with self.assertRaises(ValueError):
+      TransformerEncoder(memory_efficient=True, activation_dtype=tf.bfloat16)
+    with self.assertRaises(ValueError):
+      TransformerDecoder(memory_efficient=True, activation_dtype=tf.bfloat16)
+
+
+class UnflattenFacesTest(tf.test.TestCase):
+
+  def test_complete_faces(self):
+    """Tests faces delimited by new face tokens and a stopping token."""
+    flat_faces = np.array([2, 3, 4, 1, 5, 6, 7, 0])
+    self.assertEqual(unflatten_faces(flat_faces), [[0, 1, 2], [3, 4, 5]])
+
+  def test_trailing_incomplete_face(self):
+    """Tests that indices after the last delimiter are discarded."""
+    flat_faces = np.array([2, 3, 4, 1, 5, 6])
+    self.assertEqual(unflatten_faces(flat_faces), [[0, 1, 2]])
+
+  def test_stopping_token(self):
+    """Tests that the stopping token also ends a face."""
+    flat_faces = np.array([2, 3, 4, 0, 5, 6, 7, 1])
+    self.assertEqual(unflatten_faces(flat_faces), [[0, 1, 2], [3, 4, 5]])
+
+  def test_no_delimiter(self):
+    """Tests that a sequence without delimiters has no complete faces."""
+    self.assertEqual(unflatten_faces(np.array([2, 3, 4])), [])
+
+  def test_short_faces_removed(self):
+    """Tests that faces with two or fewer indices are removed."""
+    flat_faces = np.array([2, 3, 1, 4, 5, 6, 1, 7, 0])
+    self.assertEqual(unflatten_faces(flat_faces), [[2, 3, 4]])
+
 if __name__ == '__main__':
   tf.test.main()
@@ -222,6 +222,24 @@ def multihead_self_attention_memory_efficient(x,
     return y
 
 
+def cast_variables_getter(dtype):
+  """Returns a custom getter storing variables in float32, read as `dtype`.
+
+  Used to compute activations in a lower precision such as bfloat16, while
+  keeping float32 master weights for the optimizer.
+  """
+
+  def getter(base_getter, *args, **kwargs):
+    if kwargs.get('dtype') == dtype:
+      kwargs['dtype'] = tf.float32
+    var = base_getter(*args, **kwargs)
+    if var.dtype.base_dtype == tf.float32:
+      return tf.cast(var, dtype)
+    return var
+
+  return getter
+
+
 class TransformerEncoder(snt.AbstractModule):
   """Transformer encoder.
 
@@ -243,6 +261,7 @@ class TransformerEncoder(snt.AbstractModule):
                dropout_rate=0.2,
                re_zero=True,
                memory_efficient=False,
+               activation_dtype=tf.float32,
                name='transformer_encoder'):
     """Initializes TransformerEncoder.
 
@@ -257,9 +276,19 @@ class TransformerEncoder(snt.AbstractModule):
         fully-connected layer.
       re_zero: If True, alpha scale residuals with zero init.
       memory_efficient: If True, recompute gradients for memory savings.
+      activation_dtype: Dtype of activations, e.g. tf.bfloat16. Variables are
+        always stored in float32 and cast to this dtype when read. Only
+        float32 is supported if memory_efficient is True.
       name: Name of variable scope
     """
-    super(TransformerEncoder, self).__init__(name=name)
+    custom_getter = None
+    if activation_dtype != tf.float32:
+      if memory_efficient:
+        raise ValueError(
+            'memory_efficient attention only supports float32 activations.')
+      custom_getter = cast_variables_getter(activation_dtype)
+    super(TransformerEncoder, self).__init__(
+        custom_getter=custom_getter, name=name)
     self.hidden_size = hidden_size
     self.num_heads = num_heads
     self.layer_norm = layer_norm
@@ -268,6 +297,7 @@ class TransformerEncoder(snt.AbstractModule):
     self.dropout_rate = dropout_rate
     self.re_zero = re_zero
     self.memory_efficient = memory_efficient
+    self.activation_dtype = activation_dtype
 
   def _build(self, inputs, is_training=False):
     """Passes inputs through Transformer encoder network.
@@ -291,7 +321,7 @@ class TransformerEncoder(snt.AbstractModule):
     encoder_self_attention_bias = (
         common_attention.attention_bias_ignore_padding(encoder_padding))
 
-    x = inputs
+    x = tf.cast(inputs, self.activation_dtype)
     for layer_num in range(self.num_layers):
       with tf.variable_scope('layer_{}'.format(layer_num)):
 
@@ -343,7 +373,7 @@ class TransformerEncoder(snt.AbstractModule):
       output = common_layers.layer_norm(x, name='output')
     else:
       output = x
-    return output
+    return tf.cast(output, inputs.dtype)
 
 
 class TransformerDecoder(snt.AbstractModule):
@@ -367,6 +397,7 @@ class TransformerDecoder(snt.AbstractModule):
                dropout_rate=0.2,
                re_zero=True,
                memory_efficient=False,
+               activation_dtype=tf.float32,
                name='transformer_decoder'):
     """Initializes TransformerDecoder.
 
@@ -382,9 +413,19 @@ class TransformerDecoder(snt.AbstractModule):
         fully-connected layer.
       re_zero: If True, alpha scale residuals with zero init.
       memory_efficient: If True, recompute gradients for memory savings.
+      activation_dtype: Dtype of activations, e.g. tf.bfloat16. Variables are
+        always stored in float32 and cast to this dtype when read. Only
+        float32 is supported if memory_efficient is True.
       name: Name of variable scope
     """
-    super(TransformerDecoder, self).__init__(name=name)
+    custom_getter = None
+    if activation_dtype != tf.float32:
+      if memory_efficient:
+        raise ValueError(
+            'memory_efficient attention only supports float32 activations.')
+      custom_getter = cast_variables_getter(activation_dtype)
+    super(TransformerDecoder, self).__init__(
+        custom_getter=custom_getter, name=name)
     self.hidden_size = hidden_size
     self.num_heads = num_heads
     self.layer_norm = layer_norm
@@ -393,6 +434,7 @@ class TransformerDecoder(snt.AbstractModule):
     self.dropout_rate = dropout_rate
     self.re_zero = re_zero
     self.memory_efficient = memory_efficient
+    self.activation_dtype = activation_dtype
 
   def _build(self,
              inputs,
@@ -434,8 +476,10 @@ class TransformerDecoder(snt.AbstractModule):
           sequential_context_embeddings)
       encoder_decoder_attention_bias = (
           common_attention.attention_bias_ignore_padding(encoder_padding))
+      sequential_context_embeddings = tf.cast(
+          sequential_context_embeddings, self.activation_dtype)
 
-    x = inputs
+    x = tf.cast(inputs, self.activation_dtype)
     for layer_num in range(self.num_layers):
       with tf.variable_scope('layer_{}'.format(layer_num)):
 
@@ -521,7 +565,7 @@ class TransformerDecoder(snt.AbstractModule):
       output = common_layers.layer_norm(x, name='output')
     else:
       output = x
-    return output
+    return tf.cast(output, inputs.dtype)
 
   def create_init_cache(self, batch_size):
     """Creates empty cache dictionary for use in fast decoding."""
@@ -537,9 +581,11 @@ class TransformerDecoder(snt.AbstractModule):
 
     # Build cache
     k = common_attention.split_heads(
-        tf.zeros([batch_size, 0, self.hidden_size]), self.num_heads)
+        tf.zeros([batch_size, 0, self.hidden_size],
+                 dtype=self.activation_dtype), self.num_heads)
     v = common_attention.split_heads(
-        tf.zeros([batch_size, 0, self.hidden_size]), self.num_heads)
+        tf.zeros([batch_size, 0, self.hidden_size],
+                 dtype=self.activation_dtype), self.num_heads)
     cache = [{'k': k, 'v': v} for _ in range(self.num_layers)]
     shape_invariants = tf.nest.map_structure(
         compute_cache_shape_invariants, cache)
@@ -864,7 +910,8 @@ class VertexModel(snt.AbstractModule):
 
     Args:
       batch: Dictionary containing:
-        'vertices_flat': int32 vertex tensors of shape [batch_size, seq_length].
+        'vertices_flat': Integer vertex tensors of shape
+          [batch_size, seq_length].
       is_training: If True, use dropout.
 
     Returns:
@@ -873,8 +920,10 @@ class VertexModel(snt.AbstractModule):
     """
     global_context, seq_context = self._prepare_context(
         batch, is_training=is_training)
+    # Embedding lookups require int32 or int64 indices
+    vertices_flat = tf.cast(batch['vertices_flat'], tf.int32)
     pred_dist = self._create_dist(
-        batch['vertices_flat'][:, :-1],  # Last element not used for preds
+        vertices_flat[:, :-1],  # Last element not used for preds
         global_context_embedding=global_context,
         sequential_context_embeddings=seq_context,
         is_training=is_training)
@@ -1375,8 +1424,8 @@ class FaceModel(snt.AbstractModule):
     Args:
       batch: Dictionary containing:
         'vertices_dequantized': Tensor of shape [batch_size, num_vertices, 3].
-        'faces': int32 tensor of shape [batch_size, seq_length] with flattened
-          faces.
+        'faces': Integer tensor of shape [batch_size, seq_length] with
+          flattened faces.
         'vertices_mask': float32 tensor with shape
           [batch_size, num_vertices] that masks padded elements in 'vertices'.
       is_training: If True, use dropout.
@@ -1390,7 +1439,7 @@ class FaceModel(snt.AbstractModule):
     pred_dist = self._create_dist(
         vertex_embeddings,
         batch['vertices_mask'],
-        batch['faces'][:, :-1],
+        tf.cast(batch['faces'][:, :-1], tf.int32),
         global_context_embedding=global_context,
         sequential_context_embeddings=seq_context,
         is_training=is_training)
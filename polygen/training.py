@@ -20,6 +20,7 @@
 # In[ ]:
 
 
+from concurrent import futures
 import os
 import numpy as np
 import tensorflow.compat.v1 as tf
@@ -30,6 +31,18 @@ import matplotlib.pyplot as plt
 import modules
 import data_utils
 
+# Compile the training graph with XLA. XLA does not speed up every model and
+# has not been benchmarked on this one yet, so it is off by default. Measure
+# steps per second with and without it before turning it on.
+use_xla = False
+# Compute Transformer activations in bfloat16 while keeping float32 weights.
+# Needs hardware with bfloat16 kernels, such as TPUs.
+use_bfloat16 = False
+activation_dtype = tf.bfloat16 if use_bfloat16 else tf.float32
+# Directory for training summaries, including steps per second, which can be
+# viewed in TensorBoard.
+summary_dir = '/tmp/polygen'
+
 
 # ## Prepare a synthetic dataset
 # We prepare a dataset of meshes using four simple geometric primitives.
@@ -42,35 +55,56 @@ import data_utils
 
 
 # Prepare synthetic dataset
-ex_list = []
-for k, mesh in enumerate(['cube', 'cylinder', 'cone', 'icosphere']):
-  mesh_dict = data_utils.load_process_mesh(
-      os.path.join('meshes', '{}.obj'.format(mesh)))
+mesh_names = ['cube', 'cylinder', 'cone', 'icosphere']
+# Load and process the meshes in parallel
+with futures.ThreadPoolExecutor(max_workers=len(mesh_names)) as executor:
+  ex_list = list(executor.map(
+      lambda mesh: data_utils.load_process_mesh(
+          os.path.join('meshes', '{}.obj'.format(mesh))),
+      mesh_names))
+for k, mesh_dict in enumerate(ex_list):
   mesh_dict['class_label'] = k
-  ex_list.append(mesh_dict)
-synthetic_dataset = tf.data.Dataset.from_generator(
-    lambda: ex_list, 
-    output_types={
-        'vertices': tf.int32, 'faces': tf.int32, 'class_label': tf.int32},
-    output_shapes={
-        'vertices': tf.TensorShape([None, 3]), 'faces': tf.TensorShape([None]), 
-        'class_label': tf.TensorShape(())}
-    )
-ex = synthetic_dataset.make_one_shot_iterator().get_next()
+# Pad the meshes to a common length so the dataset can be built from in-memory
+# tensors rather than a Python generator. The padding is removed again when
+# the dataset is read.
+num_vertices = [len(mesh_dict['vertices']) for mesh_dict in ex_list]
+num_face_indices = [len(mesh_dict['faces']) for mesh_dict in ex_list]
+# Quantized vertices fit in uint8. Face indices can exceed 255 for larger
+# meshes, so they are stored as int16.
+vertices = np.zeros([len(ex_list), max(num_vertices), 3], dtype=np.uint8)
+faces = np.zeros([len(ex_list), max(num_face_indices)], dtype=np.int16)
+# Numpy wraps values that do not fit silently, so check the ranges first.
+for mesh_dict in ex_list:
+  for key, array in [('vertices', vertices), ('faces', faces)]:
+    info = np.iinfo(array.dtype)
+    assert (info.min <= mesh_dict[key].min() and
+            mesh_dict[key].max() <= info.max), (
+                'Mesh {} do not fit in {}'.format(key, array.dtype))
+for i, mesh_dict in enumerate(ex_list):
+  vertices[i, :num_vertices[i]] = mesh_dict['vertices']
+  faces[i, :num_face_indices[i]] = mesh_dict['faces']
+synthetic_dataset = tf.data.Dataset.from_tensor_slices({
+    'vertices': vertices,
+    'num_vertices': num_vertices,
+    'faces': faces,
+    'num_face_indices': num_face_indices,
+    'class_label': [mesh_dict['class_label'] for mesh_dict in ex_list]})
+synthetic_dataset = synthetic_dataset.map(lambda example: {
+    'vertices': example['vertices'][:example['num_vertices']],
+    'faces': example['faces'][:example['num_face_indices']],
+    'class_label': example['class_label']})
+# Cache the unpadded meshes so the padding is only removed once
+synthetic_dataset = synthetic_dataset.cache()
 
 # Inspect the first mesh
-with tf.Session() as sess:
-  ex_np = sess.run(ex)
-print(ex_np)
+print(ex_list[0])
 
 # Plot the meshes
 mesh_list = []
-with tf.Session() as sess:
-  for i in range(4):
-    ex_np = sess.run(ex)
-    mesh_list.append(
-        {'vertices': data_utils.dequantize_verts(ex_np['vertices']), 
-         'faces': data_utils.unflatten_faces(ex_np['faces'])})
+for mesh_dict in ex_list:
+  mesh_list.append(
+      {'vertices': data_utils.dequantize_verts(mesh_dict['vertices']),
+       'faces': data_utils.unflatten_faces(mesh_dict['faces'])})
 data_utils.plot_meshes(mesh_list, ax_lims=0.4)
 
 
@@ -87,14 +121,66 @@ data_utils.plot_meshes(mesh_list, ax_lims=0.4)
 # In[ ]:
 
 
+# With several GPUs, train a replica of each model on every GPU and reduce
+# gradients with NCCL all-reduce. Otherwise the default strategy leaves the
+# graph as it is.
+#
+# The multi-GPU path is experimental and has not been run. In particular it is
+# unverified whether TF 1.15 can split the bucketed batches across replicas,
+# and whether the on-read gradient accumulators work with the loss scale
+# optimizer.
+num_gpus = len(tf.config.experimental.list_physical_devices('GPU'))
+if num_gpus > 1:
+  strategy = tf.distribute.MirroredStrategy(
+      cross_device_ops=tf.distribute.NcclAllReduce())
+else:
+  strategy = tf.distribute.get_strategy()
+
+# With a single GPU, copy input batches to it ahead of time. Distributed
+# datasets already prefetch batches to each replica's device.
+prefetch_to_gpu = num_gpus == 1
+
+# Let the parallel maps return examples out of order if that avoids stalls.
+options = tf.data.Options()
+options.experimental_deterministic = False
+
+# Batch sequences of similar length together to reduce padding, using smaller
+# batches for longer sequences. With only four synthetic meshes of different
+# lengths, each batch holds copies of one or a few meshes, e.g. 8 cubes or 4
+# cylinders. Batch sizes are global, so they are scaled by the number of
+# replicas to split evenly across GPUs.
+bucket_boundaries = [128, 256, 384, 512]
+bucket_batch_sizes = [
+    size * strategy.num_replicas_in_sync for size in [8, 4, 4, 2, 1]]
+
 # Prepare the dataset for vertex model training
 vertex_model_dataset = data_utils.make_vertex_model_dataset(
     synthetic_dataset, apply_random_shift=False)
+# With 8-bit quantization the vertex tokens span 0 to 256, so store them as
+# int16 to reduce the size of cached examples and batches. The vertex model
+# casts them back to int32.
+vertex_model_dataset = vertex_model_dataset.map(
+    lambda example: dict(
+        example, vertices_flat=tf.cast(example['vertices_flat'], tf.int16)),
+    num_parallel_calls=tf.data.experimental.AUTOTUNE)
+# Without random shifts the vertex model inputs are deterministic, so we can
+# cache a single epoch of preprocessed examples.
+vertex_model_dataset = vertex_model_dataset.cache()
 vertex_model_dataset = vertex_model_dataset.repeat()
-vertex_model_dataset = vertex_model_dataset.padded_batch(
-    4, padded_shapes=vertex_model_dataset.output_shapes)
-vertex_model_dataset = vertex_model_dataset.prefetch(1)
-vertex_model_batch = vertex_model_dataset.make_one_shot_iterator().get_next()
+vertex_model_dataset = vertex_model_dataset.apply(
+    tf.data.experimental.bucket_by_sequence_length(
+        lambda example: tf.shape(example['vertices_flat'])[0],
+        bucket_boundaries, bucket_batch_sizes))
+vertex_model_dataset = vertex_model_dataset.with_options(options)
+if prefetch_to_gpu:
+  vertex_model_dataset = vertex_model_dataset.apply(
+      tf.data.experimental.prefetch_to_device('/gpu:0', buffer_size=2))
+else:
+  vertex_model_dataset = vertex_model_dataset.prefetch(
+      tf.data.experimental.AUTOTUNE)
+vertex_model_iterator = tf.data.make_initializable_iterator(
+    strategy.experimental_distribute_dataset(vertex_model_dataset))
+vertex_model_batch = vertex_model_iterator.get_next()
 
 # Create vertex model
 vertex_model = modules.ImageToVertexModel(
@@ -102,23 +188,37 @@ vertex_model = modules.ImageToVertexModel(
         'hidden_size': 128,
         'fc_size': 512, 
         'num_layers': 3,
-        'dropout_rate': 0.
+        'dropout_rate': 0.,
+        'activation_dtype': activation_dtype,
     },
     max_num_input_verts=250,
     quantization_bits=8,
     res_net_config ={
     }
 )
-vertex_model_pred_dist = vertex_model(vertex_model_batch)
-vertex_model_loss = -tf.reduce_sum(
-    vertex_model_pred_dist.log_prob(vertex_model_batch['vertices_flat']) * 
-    vertex_model_batch['vertices_flat_mask'])
-vertex_samples = vertex_model.sample(
-    4, context=vertex_model_batch, max_sample_length=200, top_p=0.95,
-    recenter_verts=False, only_return_complete=False)
+
+
+def vertex_model_loss_fn(batch):
+  """Returns the negative log probability of a batch of vertex sequences."""
+  # Compute the loss with the fused cross entropy op on the logits rather than
+  # through the log_prob of the predictive distribution.
+  losses = tf.nn.sparse_softmax_cross_entropy_with_logits(
+      labels=tf.cast(batch['vertices_flat'], tf.int32),
+      logits=vertex_model(batch).logits)
+  # Sum over the unpadded positions only
+  return tf.reduce_sum(tf.where(
+      tf.cast(batch['vertices_flat_mask'], tf.bool), losses,
+      tf.zeros_like(losses)))
+
+# Sample using the batch of the first replica as context.
+vertex_sample_context = tf.nest.map_structure(
+    lambda t: strategy.experimental_local_results(t)[0], vertex_model_batch)
+with strategy.scope():
+  vertex_samples = vertex_model.sample(
+      4, context=vertex_sample_context, max_sample_length=200, top_p=0.95,
+      recenter_verts=False, only_return_complete=False)
 
 print(vertex_model_batch)
-print(vertex_model_pred_dist)
 print(vertex_samples)
 
 
@@ -135,11 +235,23 @@ print(vertex_samples)
 
 face_model_dataset = data_utils.make_face_model_dataset(
     synthetic_dataset, apply_random_shift=False)
+# Vertices are randomly shuffled on each pass, so only the source meshes in
+# synthetic_dataset are cached here.
 face_model_dataset = face_model_dataset.repeat()
-face_model_dataset = face_model_dataset.padded_batch(
-    4, padded_shapes=face_model_dataset.output_shapes)
-face_model_dataset = face_model_dataset.prefetch(1)
-face_model_batch = face_model_dataset.make_one_shot_iterator().get_next()
+face_model_dataset = face_model_dataset.apply(
+    tf.data.experimental.bucket_by_sequence_length(
+        lambda example: tf.shape(example['faces'])[0],
+        bucket_boundaries, bucket_batch_sizes))
+face_model_dataset = face_model_dataset.with_options(options)
+if prefetch_to_gpu:
+  face_model_dataset = face_model_dataset.apply(
+      tf.data.experimental.prefetch_to_device('/gpu:0', buffer_size=2))
+else:
+  face_model_dataset = face_model_dataset.prefetch(
+      tf.data.experimental.AUTOTUNE)
+face_model_iterator = tf.data.make_initializable_iterator(
+    strategy.experimental_distribute_dataset(face_model_dataset))
+face_model_batch = face_model_iterator.get_next()
 
 # Create face model
 face_model = modules.FaceModel(
@@ -147,13 +259,15 @@ face_model = modules.FaceModel(
         'hidden_size': 128,
         'fc_size': 512, 
         'num_layers': 3,
-        'dropout_rate': 0.
+        'dropout_rate': 0.,
+        'activation_dtype': activation_dtype,
     },
     decoder_config={
         'hidden_size': 128,
         'fc_size': 512, 
         'num_layers': 3,
-        'dropout_rate': 0.
+        'dropout_rate': 0.,
+        'activation_dtype': activation_dtype,
     },
     class_conditional=False,
     max_seq_length=500,
@@ -161,15 +275,21 @@ face_model = modules.FaceModel(
     decoder_cross_attention=True,
     use_discrete_vertex_embeddings=True,
 )
-face_model_pred_dist = face_model(face_model_batch)
-face_model_loss = -tf.reduce_sum(
-    face_model_pred_dist.log_prob(face_model_batch['faces']) * 
-    face_model_batch['faces_mask'])
-face_samples = face_model.sample(
-    context=vertex_samples, max_sample_length=500, top_p=0.95,
-    only_return_complete=False)
+
+
+def face_model_loss_fn(batch):
+  """Returns the negative log probability of a batch of face sequences."""
+  losses = tf.nn.sparse_softmax_cross_entropy_with_logits(
+      labels=tf.cast(batch['faces'], tf.int32),
+      logits=face_model(batch).logits)
+  return tf.reduce_sum(tf.where(
+      tf.cast(batch['faces_mask'], tf.bool), losses, tf.zeros_like(losses)))
+
+with strategy.scope():
+  face_samples = face_model.sample(
+      context=vertex_samples, max_sample_length=500, top_p=0.95,
+      only_return_complete=False)
 print(face_model_batch)
-print(face_model_pred_dist)
 print(face_samples)
 
 
@@ -182,35 +302,181 @@ print(face_samples)
 
 # Optimization settings
 learning_rate = 5e-4
+# Number of optimizer updates. Each update averages the gradients of
+# accumulation_steps batches, so training reads accumulation_steps times as
+# many batches as there are steps.
 training_steps = 50
 check_step = 5
+# Use float16 matmuls with dynamic loss scaling on supported GPUs. bfloat16
+# activations have float32 range and need no loss scaling.
+use_mixed_precision = not use_bfloat16
+# Number of batches to accumulate gradients over for each optimizer update
+accumulation_steps = 4
 
 # Create an optimizer an minimize the summed log probability of the mesh 
 # sequences
-optimizer = tf.train.AdamOptimizer(learning_rate)
-vertex_model_optim_op = optimizer.minimize(vertex_model_loss)
-face_model_optim_op = optimizer.minimize(face_model_loss)
+with strategy.scope():
+  optimizer = tf.train.AdamOptimizer(learning_rate)
+  if use_mixed_precision:
+    optimizer = tf.train.experimental.enable_mixed_precision_graph_rewrite(
+        optimizer)
+  global_step = tf.train.get_or_create_global_step()
+
+
+def compute_gradients(vertex_model_batch, face_model_batch):
+  """Returns the losses and gradients of one batch on a replica.
+
+  Gradients are returned in a dict keyed by variable name. Variables that the
+  losses do not depend on are left out.
+  """
+  vertex_model_loss = vertex_model_loss_fn(vertex_model_batch)
+  face_model_loss = face_model_loss_fn(face_model_batch)
+  # The two models share no variables, so minimizing the summed loss gives the
+  # same gradients as minimizing each loss separately, in a single update.
+  grads_and_vars = optimizer.compute_gradients(
+      vertex_model_loss + face_model_loss)
+  # Gradients are summed into dense accumulators, so densify sparse embedding
+  # gradients here.
+  grads = {v.op.name: tf.convert_to_tensor(g)
+           for g, v in grads_and_vars if g is not None}
+  return vertex_model_loss, face_model_loss, grads
+
+
+vertex_model_loss, face_model_loss, grads = strategy.experimental_run_v2(
+    compute_gradients, args=(vertex_model_batch, face_model_batch))
+
+# Update the variables that receive gradients, and make sure that is every
+# trainable variable, so none is silently left untrained.
+var_names = sorted(grads)
+vars_by_name = {v.op.name: v for v in tf.trainable_variables()}
+assert set(var_names) == set(vars_by_name), (
+    'No gradients for {}'.format(sorted(set(vars_by_name) - set(var_names))))
+train_vars = [vars_by_name[name] for name in var_names]
+
+# Sum gradients over accumulation_steps batches, then apply their mean in a
+# single Adam update and reset the sums. Each replica accumulates its own
+# gradients, which are all-reduced by the optimizer when they are applied.
+with strategy.scope():
+  accum_grads = [
+      tf.Variable(tf.zeros(v.shape, dtype=v.dtype.base_dtype),
+                  trainable=False,
+                  synchronization=tf.VariableSynchronization.ON_READ,
+                  aggregation=tf.VariableAggregation.SUM)
+      for v in train_vars]
+
+
+def accumulate_step(vertex_model_loss, face_model_loss, grads):
+  """Adds the gradients of one batch to the accumulators of a replica."""
+  accumulate_op = tf.group(
+      *[a.assign_add(grads[name]) for a, name in zip(accum_grads, var_names)])
+  with tf.control_dependencies([accumulate_op]):
+    return tf.identity(vertex_model_loss), tf.identity(face_model_loss)
+
+
+def apply_step(vertex_model_loss, face_model_loss):
+  """Applies the mean accumulated gradients and resets the accumulators.
+
+  The update runs after the gradients of the batch behind the given losses
+  have been accumulated.
+  """
+  with tf.control_dependencies([vertex_model_loss, face_model_loss]):
+    apply_op = optimizer.apply_gradients(
+        [(a / accumulation_steps, v) for a, v in zip(accum_grads, train_vars)],
+        global_step=global_step)
+  with tf.control_dependencies([apply_op]):
+    return tf.group(*[a.assign(tf.zeros_like(a)) for a in accum_grads])
+
+# Fetching the losses accumulates the gradients of the current batch. The
+# train op also applies the update, so it is run with the last batch of each
+# update instead of the losses.
+vertex_model_loss, face_model_loss = strategy.experimental_run_v2(
+    accumulate_step, args=(vertex_model_loss, face_model_loss, grads))
+train_op = tf.group(*strategy.experimental_local_results(
+    strategy.experimental_run_v2(
+        apply_step, args=(vertex_model_loss, face_model_loss))))
+vertex_model_loss = strategy.reduce(
+    tf.distribute.ReduceOp.SUM, vertex_model_loss, axis=None)
+face_model_loss = strategy.reduce(
+    tf.distribute.ReduceOp.SUM, face_model_loss, axis=None)
+
+
+class SampleMeshesHook(tf.train.SessionRunHook):
+  """Samples meshes in a background thread and plots them every n steps."""
+
+  def __init__(self, vertex_samples, face_samples, every_n_steps):
+    self._samples = (vertex_samples, face_samples)
+    self._timer = tf.train.SecondOrStepTimer(every_steps=every_n_steps)
+
+  def begin(self):
+    self._global_step = tf.train.get_global_step()
+    # A single worker keeps sampling off the training thread without letting
+    # samples pile up. Pyplot is not thread safe, so the samples are plotted
+    # on the main thread once they are ready.
+    self._executor = futures.ThreadPoolExecutor(max_workers=1)
+    self._pending = None
+
+  def before_run(self, run_context):
+    return tf.train.SessionRunArgs(self._global_step)
+
+  def after_run(self, run_context, run_values):
+    step = run_values.results
+    if self._pending is not None:
+      # Skip this step if the previous samples are still being computed
+      if not self._pending.done():
+        return
+      self._plot(self._pending.result())
+      self._pending = None
+    if self._timer.should_trigger_for_step(step):
+      self._timer.update_last_triggered_step(step)
+      self._pending = self._executor.submit(
+          run_context.session.run, self._samples)
+
+  def end(self, session):
+    self._executor.shutdown(wait=True)
+    if self._pending is not None:
+      self._plot(self._pending.result())
+
+  def _plot(self, samples_np):
+    v_samples_np, f_samples_np = samples_np
+    mesh_list = []
+    # Batches of long sequences can hold fewer than four samples
+    for n in range(len(v_samples_np['vertices'])):
+      mesh_list.append(
+          {
+              'vertices': v_samples_np['vertices'][n][:v_samples_np['num_vertices'][n]],
+              'faces': data_utils.unflatten_faces(
+                  f_samples_np['faces'][n][:f_samples_np['num_face_indices'][n]])
+          }
+      )
+    data_utils.plot_meshes(mesh_list, ax_lims=0.5)
 
 # Training loop
-with tf.Session() as sess:
-  sess.run(tf.global_variables_initializer())
+config = tf.ConfigProto()
+if use_xla:
+  config.graph_options.optimizer_options.global_jit_level = (
+      tf.OptimizerOptions.ON_1)
+# Iterators are initialized with the local variables when the session starts
+scaffold = tf.train.Scaffold(local_init_op=tf.group(
+    tf.local_variables_initializer(), vertex_model_iterator.initializer,
+    face_model_iterator.initializer))
+hooks = [
+    SampleMeshesHook(vertex_samples, face_samples, every_n_steps=check_step),
+]
+with tf.train.MonitoredTrainingSession(
+    scaffold=scaffold, hooks=hooks, config=config, summary_dir=summary_dir,
+    log_step_count_steps=check_step) as sess:
   for n in range(training_steps):
+    # Average the losses over the batches that make up this update
+    v_loss = f_loss = 0.
+    for k in range(accumulation_steps):
+      fetches = {'v_loss': vertex_model_loss, 'f_loss': face_model_loss}
+      # Apply the update in the same run as the last batch
+      if k == accumulation_steps - 1:
+        fetches['train_op'] = train_op
+      outputs = sess.run(fetches)
+      v_loss += outputs['v_loss'] / accumulation_steps
+      f_loss += outputs['f_loss'] / accumulation_steps
     if n % check_step == 0:
-      v_loss, f_loss = sess.run((vertex_model_loss, face_model_loss))
       print('Step {}'.format(n))
       print('Loss (vertices) {}'.format(v_loss))
       print('Loss (faces) {}'.format(f_loss))
-      v_samples_np, f_samples_np, b_np = sess.run(
-        (vertex_samples, face_samples, vertex_model_batch))
-      mesh_list = []
-      for n in range(4):
-        mesh_list.append(
-            {
-                'vertices': v_samples_np['vertices'][n][:v_samples_np['num_vertices'][n]],
-                'faces': data_utils.unflatten_faces(
-                    f_samples_np['faces'][n][:f_samples_np['num_face_indices'][n]])
-            }
-        )
-      data_utils.plot_meshes(mesh_list, ax_lims=0.5)
-    sess.run((vertex_model_optim_op, face_model_optim_op))
-